@@ -6,37 +6,169 @@ import pathlib
 import subprocess
 import time
 import shutil
+import stat
 import tempfile
+import traceback
+import hashlib
+import json
+import importlib.util
+import functools
+import atexit
+import threading
+import types
+from collections import ChainMap
+from collections.abc import Mapping
 import yaml
+import jinja2
+import jinja2.meta
 import requests
+import websocket
 from dataclasses import dataclass
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
-from concurrent.futures import ThreadPoolExecutor
+from watchdog.observers.inotify import InotifyObserver
+from watchdog.events import PatternMatchingEventHandler
+from concurrent.futures import ThreadPoolExecutor, wait
+# Use the libyaml-backed loader when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 HASS_CONFIG_DIR = os.getenv('HASS_CONFIG_DIR')
 CONFIG_FILE_NAME = 'jinja2config.yaml'
 CONFIG_FILE_PATH = pathlib.Path(HASS_CONFIG_DIR) / CONFIG_FILE_NAME
 CACHED_CONFIG_VARS = {}
-CACHED_HA_ENTITIES = None
+CACHED_CONFIG_STAT = None
 FILE_CONFIGS_KEY = '.file_configs'
 SKIPPED_FILES_KEY = '.skipped_files'
+SKIP_PRETTIER_KEY = '.skip_prettier'
 HA_ENTITIES_KEY = 'ha_entities'
+SPECIAL_KEYS = (FILE_CONFIGS_KEY, SKIPPED_FILES_KEY)
+CUSTOMIZATIONS_FILE_PATH = pathlib.Path('/etc/jinja2config/j2_customizations.py')
+PRETTIER_SERVER_PATH = pathlib.Path('/usr/lib/jinja2config/prettier_server.js')
+PRETTIER_SERVER: subprocess.Popen | None = None
+PRETTIER_SERVER_LOCK = threading.Lock()
+# Persistent add-on storage, so compiled templates survive restarts.
+# Each Environment configuration gets its own subdirectory, named after ENV_FINGERPRINT.
+BYTECODE_CACHE_DIR = pathlib.Path('/data/jinja2config-bc')
+# Input hashes of the generated outputs, mirroring their paths relative to HASS_CONFIG_DIR.
+# Kept in add-on storage so no extra files show up in the user's config directory.
+HASH_DIR = pathlib.Path('/data/jinja2config-hashes')
+ENV_FINGERPRINT = ''
 
 # Home Assistant API configuration
 SUPERVISOR_TOKEN = os.getenv('SUPERVISOR_TOKEN')
 HA_API_URL = 'http://supervisor/core/api'
+HA_WEBSOCKET_URL = 'ws://supervisor/core/websocket'
+HA_WEBSOCKET_RETRY_SECONDS = 30
+# Ping after this long without a message; a ping that also gets no answer means the connection is dead
+HA_WEBSOCKET_PING_SECONDS = 30
+# Kept up to date by the websocket subscription thread, guarded by LIVE_HA_ENTITIES_LOCK
+LIVE_HA_ENTITIES = {}
+LIVE_HA_ENTITIES_LOCK = threading.Lock()
+LIVE_HA_ENTITIES_READY = threading.Event()
+# Set while the websocket cannot connect, in which case the REST API is most likely down as well
+HA_WEBSOCKET_FAILED = threading.Event()
+
+def sync_ha_entities(ws: websocket.WebSocket):
+    """Authenticate on an open websocket and mirror all entity states into LIVE_HA_ENTITIES.
+    
+    Loads the full state list once, then applies state_changed events until the connection fails.
+    Idle connections are pinged, so a connection that silently died raises instead of blocking forever.
+    """
+    json.loads(ws.recv())  # auth_required
+    ws.send(json.dumps({'type': 'auth', 'access_token': SUPERVISOR_TOKEN}))
+    message = json.loads(ws.recv())
+    if message.get('type') != 'auth_ok':
+        raise RuntimeError(f"authentication failed: {message.get('message')}")
+    
+    # Subscribe before requesting the states so no change in between is missed
+    ws.send(json.dumps({'id': 1, 'type': 'subscribe_events', 'event_type': 'state_changed'}))
+    ws.send(json.dumps({'id': 2, 'type': 'get_states'}))
+    ws.settimeout(HA_WEBSOCKET_PING_SECONDS)
+    next_id = 3
+    ping_pending = False
+    while True:
+        try:
+            message = json.loads(ws.recv())
+        except websocket.WebSocketTimeoutException:
+            if ping_pending:
+                raise RuntimeError("no answer to ping, reconnecting")
+            ws.send(json.dumps({'id': next_id, 'type': 'ping'}))
+            next_id += 1
+            ping_pending = True
+            continue
+        ping_pending = False
+        if message.get('type') == 'result' and message.get('id') == 2:
+            if not message.get('success'):
+                raise RuntimeError(f"get_states failed: {message.get('error')}")
+            with LIVE_HA_ENTITIES_LOCK:
+                LIVE_HA_ENTITIES.clear()
+                LIVE_HA_ENTITIES.update({entity['entity_id']: entity for entity in message['result']})
+            LIVE_HA_ENTITIES_READY.set()
+            print(f"Subscribed to {len(LIVE_HA_ENTITIES)} entities from Home Assistant")
+        elif message.get('type') == 'event':
+            data = message['event']['data']
+            with LIVE_HA_ENTITIES_LOCK:
+                if data.get('new_state') is None:
+                    LIVE_HA_ENTITIES.pop(data['entity_id'], None)
+                else:
+                    LIVE_HA_ENTITIES[data['entity_id']] = data['new_state']
+
+def subscribe_ha_entities():
+    """Keep LIVE_HA_ENTITIES in sync with Home Assistant, reconnecting after errors."""
+    while True:
+        try:
+            ws = websocket.create_connection(HA_WEBSOCKET_URL, timeout=10)
+        except Exception as e:
+            print(f"Warning: Cannot connect to the Home Assistant websocket: {e}")
+            HA_WEBSOCKET_FAILED.set()
+        else:
+            HA_WEBSOCKET_FAILED.clear()
+            try:
+                sync_ha_entities(ws)
+            except Exception as e:
+                print(f"Warning: Home Assistant websocket error: {e}")
+            finally:
+                ws.close()
+        LIVE_HA_ENTITIES_READY.clear()
+        time.sleep(HA_WEBSOCKET_RETRY_SECONDS)
+
+def start_ha_entities_subscription():
+    """Start the background websocket subscription and give it a moment to load the states.
+    
+    Returns as soon as the states are loaded or the first connection attempt failed,
+    e.g. because Home Assistant Core is not up yet.
+    """
+    if not SUPERVISOR_TOKEN:
+        return
+    threading.Thread(target=subscribe_ha_entities, name='ha-entities', daemon=True).start()
+    deadline = time.monotonic() + 10
+    while not HA_WEBSOCKET_FAILED.is_set() and time.monotonic() < deadline:
+        if LIVE_HA_ENTITIES_READY.wait(timeout=0.1):
+            break
 
 def fetch_ha_entities():
     """Fetch all entities from Home Assistant API.
     
     Returns a dictionary with entity_id as keys and entity state objects as values.
+    Uses a snapshot of the websocket subscription when it is connected, and falls back
+    to a full /states request otherwise, unless the websocket could not even connect.
     Returns None if the API is not accessible or an error occurs.
     """
     if not SUPERVISOR_TOKEN:
         print("Warning: SUPERVISOR_TOKEN not available, cannot fetch HA entities")
         return None
     
+    if LIVE_HA_ENTITIES_READY.is_set():
+        with LIVE_HA_ENTITIES_LOCK:
+            entity_dict = dict(LIVE_HA_ENTITIES)
+        print(f"Using {len(entity_dict)} entities from the Home Assistant subscription")
+        return entity_dict
+    if HA_WEBSOCKET_FAILED.is_set():
+        # Don't wait for another timeout on the same unreachable Core
+        print("Warning: Home Assistant is not reachable, cannot fetch HA entities")
+        return None
+    
     try:
         headers = {
             'Authorization': f'Bearer {SUPERVISOR_TOKEN}',
@@ -65,125 +197,344 @@ def fetch_ha_entities():
         print(f"Warning: Unexpected error fetching HA entities: {e}")
         return None
 
-def is_file_skipped(file_path: pathlib.Path) -> bool:
+def _read_only(self, *args, **kwargs):
+    raise TypeError(f"{type(self).__name__} is read-only, copy it before modifying it")
+
+class FrozenDict(dict):
+    """A dict that cannot be modified, so renders can't change variables shared with other renders.
+    
+    Subclassing dict (rather than using MappingProxyType) keeps filters like tojson working.
+    """
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+    
+    def __reduce__(self):
+        return FrozenDict, (dict(self),)
+
+class FrozenList(list):
+    """A list that cannot be modified, see FrozenDict. Concatenating it still returns a plain list."""
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+    
+    def __reduce__(self):
+        return FrozenList, (list(self),)
+
+# Let custom filters that dump YAML handle frozen variables like plain ones
+for _representer in (yaml.representer.SafeRepresenter, yaml.representer.Representer):
+    _representer.add_representer(FrozenDict, yaml.representer.SafeRepresenter.represent_dict)
+    _representer.add_representer(FrozenList, yaml.representer.SafeRepresenter.represent_list)
+
+def freeze(value):
+    """Recursively convert dicts, lists and sets to read-only equivalents."""
+    if isinstance(value, FrozenDict | FrozenList | frozenset):
+        return value
+    if isinstance(value, dict):
+        return FrozenDict({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return FrozenList(freeze(v) for v in value)
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+@dataclass(frozen=True, eq=False)
+class ConfigSnapshot:
+    """Everything derived from one config load.
+    
+    load_config_variables() replaces CONFIG with a new snapshot in a single assignment and
+    never modifies one, so a compile that reads CONFIG once sees consistent state even if
+    the config is reloaded while it runs. Snapshots compare and hash by identity, so they
+    can key the per-file caches.
+    """
+    base_vars: Mapping
+    file_configs: Mapping
+    skipped_files: frozenset[str]
+    ha_entities: Mapping | None
+
+CONFIG = ConfigSnapshot(types.MappingProxyType({}), types.MappingProxyType({}), frozenset(), None)
+
+def is_file_skipped(file_path: pathlib.Path, config: ConfigSnapshot) -> bool:
     """Check if a file should be skipped based on .skipped_files configuration.
     
     Returns True if the file should be skipped, False otherwise.
     The file path is relative to HASS_CONFIG_DIR.
     """
-    if SKIPPED_FILES_KEY not in CACHED_CONFIG_VARS:
-        return False
-    
-    skipped_files = CACHED_CONFIG_VARS[SKIPPED_FILES_KEY]
-    if not isinstance(skipped_files, list):
+    try:
+        return str(file_path.relative_to(HASS_CONFIG_DIR)) in config.skipped_files
+    except ValueError:
+        # File is not relative to HASS_CONFIG_DIR
         return False
+
+def is_prettier_skipped(file_path: pathlib.Path, config: ConfigSnapshot) -> bool:
+    """Check if a file opted out of Prettier formatting with .skip_prettier in its .file_configs entry.
     
-    # Get the relative path from HASS_CONFIG_DIR
+    The file path is relative to HASS_CONFIG_DIR.
+    """
     try:
-        relative_path = file_path.relative_to(HASS_CONFIG_DIR)
-        relative_path_str = str(relative_path)
-        
-        # Check if this file is in the skipped list
-        if relative_path_str in skipped_files:
-            return True
+        file_config = config.file_configs.get(str(file_path.relative_to(HASS_CONFIG_DIR)))
     except ValueError:
         # File is not relative to HASS_CONFIG_DIR
-        pass
-    
-    return False
+        return False
+    return isinstance(file_config, dict) and file_config.get(SKIP_PRETTIER_KEY) is True
 
-def deep_merge(base: dict, override: dict) -> dict:
+def deep_merge(base: Mapping, override: dict) -> dict:
     """Deep merge two dictionaries, with override values taking precedence.
     
-    Recursively merges nested dictionaries. Lists and other types are replaced, not merged.
-    Returns a new dictionary without modifying the originals.
+    Nested dictionaries are merged iteratively. Lists and other types are replaced, not merged.
+    Returns a new, frozen dictionary without modifying the originals. Only the nested
+    dictionaries touched by the override are copied; everything else is shared with base.
     """
-    result = {}
-    # Start with all keys from base
-    for key, value in base.items():
-        if isinstance(value, dict):
-            result[key] = value.copy()
-        else:
-            result[key] = value
-    
-    # Apply overrides
-    for key, value in override.items():
-        if key in result and isinstance(result[key], dict) and isinstance(value, dict):
-            result[key] = deep_merge(result[key], value)
-        else:
-            result[key] = value
-    return result
+    result = dict(base)
+    stack = [(result, override)]
+    copies = []
+    while stack:
+        target, overrides = stack.pop()
+        for key, value in overrides.items():
+            current = target.get(key)
+            if isinstance(current, dict) and isinstance(value, dict):
+                # Copy just this level before writing into it
+                merged = dict(current)
+                target[key] = merged
+                copies.append((target, key, merged))
+                stack.append((merged, value))
+            else:
+                target[key] = value
+    # Freeze the copies again, innermost first, as each copy is made after its parent
+    for target, key, merged in reversed(copies):
+        target[key] = FrozenDict(merged)
+    return FrozenDict(result)
 
-def get_variables_for_file(file_path: pathlib.Path) -> dict:
-    """Get variables for a specific file, merging global and file-specific configs.
+@functools.lru_cache(maxsize=4096)
+def _merged_for(relative_path_str: str | None, config: ConfigSnapshot) -> Mapping:
+    """Build the variables for a template, with the file-specific config for relative_path_str merged in.
     
-    Returns a deep merge of global variables with file-specific overrides.
-    The file path is relative to HASS_CONFIG_DIR.
+    Everything is read from the given snapshot, which is also the cache key, so results are
+    never mixed between config loads. The cache is also cleared on every config load.
     """
-    # Start with base config (excluding special keys)
-    base_vars = {k: v for k, v in CACHED_CONFIG_VARS.items() 
-                 if k not in (FILE_CONFIGS_KEY, SKIPPED_FILES_KEY)}
+    if relative_path_str is None:
+        # Share the frozen global variables instead of copying them
+        if config.ha_entities is None:
+            return config.base_vars
+        return ChainMap({HA_ENTITIES_KEY: config.ha_entities}, config.base_vars)
     
-    # Add Home Assistant entities if available
-    if CACHED_HA_ENTITIES is not None:
-        base_vars[HA_ENTITIES_KEY] = CACHED_HA_ENTITIES
-    
-    # Check if there are file-specific configs
-    if FILE_CONFIGS_KEY not in CACHED_CONFIG_VARS:
-        return base_vars
-    
-    file_configs = CACHED_CONFIG_VARS[FILE_CONFIGS_KEY]
-    if not isinstance(file_configs, dict):
-        return base_vars
+    base_vars = _merged_for(None, config)
+    print(f"Applying file-specific config for {relative_path_str}")
+    return deep_merge(base_vars, config.file_configs[relative_path_str])
+
+def _canonicalize(value):
+    """Convert nested variables to tuples with a stable order, whatever the key types are."""
+    if isinstance(value, Mapping):
+        items = ((str(k), _canonicalize(v)) for k, v in value.items())
+        return tuple(sorted(items, key=lambda item: item[0]))
+    if isinstance(value, (list, tuple)):
+        return tuple(_canonicalize(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(repr(_canonicalize(v)) for v in value))
+    return value
+
+@functools.lru_cache(maxsize=4096)
+def _vars_digest(relative_path_str: str | None, config: ConfigSnapshot) -> str:
+    """Hash the variables _merged_for() returns for the same arguments.
     
+    Cached the same way, so the variables are only serialized once per config load
+    rather than once per compile.
+    """
+    merged = _merged_for(relative_path_str, config)
+    return hashlib.blake2b(repr(_canonicalize(merged)).encode()).hexdigest()
+
+def _file_config_key(file_path: pathlib.Path, config: ConfigSnapshot) -> str | None:
+    """Return the .file_configs key that applies to file_path, or None if there is none."""
+    if not config.file_configs:
+        return None
     # Get the relative path from HASS_CONFIG_DIR
     try:
-        relative_path = file_path.relative_to(HASS_CONFIG_DIR)
-        relative_path_str = str(relative_path)
-        
-        # Check if there's a config for this specific file
-        if relative_path_str in file_configs:
-            file_specific_config = file_configs[relative_path_str]
-            if isinstance(file_specific_config, dict):
-                print(f"Applying file-specific config for {relative_path_str}")
-                return deep_merge(base_vars, file_specific_config)
+        relative_path = str(file_path.relative_to(HASS_CONFIG_DIR))
     except ValueError:
         # File is not relative to HASS_CONFIG_DIR
-        pass
+        return None
+    
+    # Check if there's a config for this specific file
+    if isinstance(config.file_configs.get(relative_path), dict):
+        return relative_path
+    return None
+
+def get_variables_for_file(file_path: pathlib.Path, config: ConfigSnapshot) -> Mapping:
+    """Get variables for a specific file, merging global and file-specific configs.
     
-    return base_vars
+    Returns a deep merge of global variables with file-specific overrides.
+    The file path is relative to HASS_CONFIG_DIR.
+    The returned mapping is cached and shared between calls, so it must not be modified.
+    """
+    return _merged_for(_file_config_key(file_path, config), config)
+
+def get_variables_digest(file_path: pathlib.Path, config: ConfigSnapshot) -> str:
+    """Get a hash of the variables get_variables_for_file() returns for file_path."""
+    return _vars_digest(_file_config_key(file_path, config), config)
 
 def load_config_variables():
-    """Load variables from jinja2config.yaml and cache them. Also refresh HA entities."""
-    global CACHED_CONFIG_VARS, CACHED_HA_ENTITIES
+    """Load variables from jinja2config.yaml and cache them. Also refresh HA entities.
+    
+    The file is only parsed again if its modification time or size changed since the last load.
+    """
+    global CACHED_CONFIG_VARS, CACHED_CONFIG_STAT, CONFIG
     if CONFIG_FILE_PATH.exists():
-        try:
-            with open(CONFIG_FILE_PATH, 'r') as f:
-                config = yaml.safe_load(f)
-                if isinstance(config, dict):
-                    CACHED_CONFIG_VARS = config
-                    print(f"Loaded {len(config)} variables from {CONFIG_FILE_NAME}")
-                else:
-                    print(f"Warning: {CONFIG_FILE_NAME} does not contain a dictionary")
-                    CACHED_CONFIG_VARS = {}
-        except yaml.YAMLError as e:
-            print(f"Error parsing {CONFIG_FILE_NAME}: {e}")
-            CACHED_CONFIG_VARS = {}
-        except Exception as e:
-            print(f"Error loading {CONFIG_FILE_NAME}: {e}")
-            CACHED_CONFIG_VARS = {}
+        st = CONFIG_FILE_PATH.stat()
+        config_stat = (st.st_mtime_ns, st.st_size)
+        if config_stat == CACHED_CONFIG_STAT:
+            print(f"{CONFIG_FILE_NAME} unchanged, using cached variables")
+        else:
+            CACHED_CONFIG_STAT = None
+            try:
+                with open(CONFIG_FILE_PATH, 'r') as f:
+                    config = yaml.load(f, Loader=YamlLoader)
+                    if isinstance(config, dict):
+                        # Deep-frozen, as all renders share the variables
+                        CACHED_CONFIG_VARS = freeze(config)
+                        CACHED_CONFIG_STAT = config_stat
+                        print(f"Loaded {len(config)} variables from {CONFIG_FILE_NAME}")
+                    else:
+                        print(f"Warning: {CONFIG_FILE_NAME} does not contain a dictionary")
+                        CACHED_CONFIG_VARS = {}
+            except yaml.YAMLError as e:
+                print(f"Error parsing {CONFIG_FILE_NAME}: {e}")
+                CACHED_CONFIG_VARS = {}
+            except Exception as e:
+                print(f"Error loading {CONFIG_FILE_NAME}: {e}")
+                CACHED_CONFIG_VARS = {}
     else:
         print(f"{CONFIG_FILE_NAME} not found, using empty context")
         CACHED_CONFIG_VARS = {}
+        CACHED_CONFIG_STAT = None
     
     # Refresh Home Assistant entities
-    CACHED_HA_ENTITIES = fetch_ha_entities()
+    ha_entities = freeze(fetch_ha_entities())
+    
+    # Precompute the global variables (excluding special keys) shared by all templates
+    base_vars = types.MappingProxyType({k: v for k, v in CACHED_CONFIG_VARS.items() if k not in SPECIAL_KEYS})
+    skipped_files = CACHED_CONFIG_VARS.get(SKIPPED_FILES_KEY)
+    if isinstance(skipped_files, list):
+        skipped_files = frozenset(f for f in skipped_files if isinstance(f, str))
+    else:
+        skipped_files = frozenset()
+    file_configs = CACHED_CONFIG_VARS.get(FILE_CONFIGS_KEY)
+    if not isinstance(file_configs, dict):
+        file_configs = {}
+    # Publish everything at once; compiles already running keep the snapshot they started with
+    CONFIG = ConfigSnapshot(base_vars, types.MappingProxyType(file_configs), skipped_files, ha_entities)
+    _merged_for.cache_clear()
+    _vars_digest.cache_clear()
+
+def load_customizations():
+    """Load the Jinja2 customizations module rendered from the add-on options.
+    
+    Returns the loaded module, or None if the customizations file does not exist.
+    """
+    if not CUSTOMIZATIONS_FILE_PATH.exists():
+        print(f"{CUSTOMIZATIONS_FILE_PATH} not found, using default Jinja2 settings")
+        return None
+    
+    spec = importlib.util.spec_from_file_location('j2_customizations', CUSTOMIZATIONS_FILE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def env_lookup(varname: str, default: str | None = None) -> str:
+    """Return the value of an environment variable, like jinjanator's env filter and global.
+    
+    Raises KeyError if the variable is not set and no default is given.
+    """
+    if default is not None:
+        return os.environ.get(varname, default)
+    if varname not in os.environ:
+        raise KeyError(f"Environment variable {varname} is not set")
+    return os.environ[varname]
+
+def environment_fingerprint(params: dict) -> str:
+    """Hash the Environment parameters together with the customizations source.
+    
+    Jinja keys its bytecode cache only on the template name and source, so anything
+    that changes how templates are lexed or rendered has to be keyed separately.
+    """
+    digest = hashlib.blake2b(repr(sorted(params.items())).encode())
+    if CUSTOMIZATIONS_FILE_PATH.exists():
+        digest.update(b'\0')
+        digest.update(CUSTOMIZATIONS_FILE_PATH.read_bytes())
+    return digest.hexdigest()
+
+def create_bytecode_cache(fingerprint: str) -> jinja2.BytecodeCache | None:
+    """Create the bytecode cache for an Environment configuration, removing caches of other configurations."""
+    cache_dir = BYTECODE_CACHE_DIR / fingerprint[:16]
+    try:
+        if BYTECODE_CACHE_DIR.exists():
+            for stale_path in BYTECODE_CACHE_DIR.iterdir():
+                if stale_path == cache_dir:
+                    continue
+                if stale_path.is_dir():
+                    shutil.rmtree(stale_path, ignore_errors=True)
+                else:
+                    stale_path.unlink(missing_ok=True)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        return jinja2.FileSystemBytecodeCache(directory=str(cache_dir))
+    except OSError as e:
+        print(f"Warning: Cannot use bytecode cache directory {cache_dir}: {e}")
+        return None
+
+class ConfigDirLoader(jinja2.FileSystemLoader):
+    """Load templates relative to HASS_CONFIG_DIR, and absolute template names as-is.
+    
+    jinjanator's FilePathLoader accepted absolute paths, so existing templates may
+    include files like '/config/macros.jinja'.
+    """
+    def __init__(self, searchpath: str):
+        super().__init__(searchpath)
+        self._root_loader = jinja2.FileSystemLoader('/')
+    
+    def get_source(self, environment: jinja2.Environment, template: str):
+        if template.startswith('/'):
+            return self._root_loader.get_source(environment, template)
+        return super().get_source(environment, template)
+
+def create_environment() -> jinja2.Environment:
+    """Create the shared Jinja2 environment used to render all templates.
+    
+    Templates are loaded relative to HASS_CONFIG_DIR, or by absolute path. Delimiters, filters and tests
+    are taken from the customizations module, if present. The extensions and the env
+    filter/global match what jinjanator provided.
+    """
+    global ENV_FINGERPRINT
+    customizations = load_customizations()
+    
+    params = {}
+    if customizations is not None and hasattr(customizations, 'j2_environment_params'):
+        params.update(customizations.j2_environment_params())
+    params.setdefault('extensions', ['jinja2.ext.i18n', 'jinja2.ext.do', 'jinja2.ext.loopcontrols'])
+    ENV_FINGERPRINT = environment_fingerprint(params)
+    bytecode_cache = create_bytecode_cache(ENV_FINGERPRINT)
+    
+    env = jinja2.Environment(
+        loader=ConfigDirLoader(HASS_CONFIG_DIR),
+        undefined=jinja2.StrictUndefined,
+        keep_trailing_newline=True,
+        auto_reload=True,
+        cache_size=400,
+        bytecode_cache=bytecode_cache,
+        **params,
+    )
+    
+    env.filters['env'] = env_lookup
+    env.globals['env'] = env_lookup
+    
+    if customizations is not None:
+        if hasattr(customizations, 'extra_filters'):
+            for name, func in customizations.extra_filters().items():
+                env.filters[name] = func
+        if hasattr(customizations, 'extra_tests'):
+            for name, func in customizations.extra_tests().items():
+                env.tests[name] = func
+    return env
+
+ENV = create_environment()
 
 def check_dependencies():
-    if not shutil.which('j2'):
-        print("jinjanator must be installed: pip install jinjanator (https://github.com/kpfleming/jinjanator)")
-        time.sleep(1)
-        exit(1)
     if not shutil.which('prettier'):
         print("Prettier must be installed: apt-get install nodejs npm && npm install -g prettier")
         time.sleep(1)
@@ -195,6 +546,64 @@ def get_output_file(file_path: pathlib.Path):
         output_file = output_file.with_suffix('')
     return output_file
 
+def get_hash_file(output_file: pathlib.Path):
+    return HASH_DIR / f"{output_file.relative_to(HASS_CONFIG_DIR)}.hash"
+
+def store_input_hash(output_file: pathlib.Path, input_hash: str | None):
+    """Record the input hash of a written output, or forget the stored one if input_hash is None."""
+    hash_file = get_hash_file(output_file)
+    try:
+        if input_hash is None:
+            hash_file.unlink(missing_ok=True)
+        else:
+            hash_file.parent.mkdir(parents=True, exist_ok=True)
+            hash_file.write_text(input_hash)
+    except OSError as e:
+        print(f"Warning: Cannot store the input hash of {output_file}: {e}")
+
+@functools.lru_cache(maxsize=1024)
+def _referenced_templates(name: str, source: str) -> tuple:
+    """List the templates a template source includes, imports or extends."""
+    return tuple(jinja2.meta.find_referenced_templates(ENV.parse(source, name)))
+
+def compute_input_hash(file_path: pathlib.Path, vars_digest: str) -> str:
+    """Hash everything a render depends on.
+    
+    Covers the Environment configuration, the template source, the sources of all templates
+    it references (recursively), and the variables it is rendered with. Raises if a
+    reference cannot be resolved statically, as the inputs are then unknown.
+    """
+    digest = hashlib.blake2b(ENV_FINGERPRINT.encode())
+    pending = [file_path.relative_to(HASS_CONFIG_DIR).as_posix()]
+    seen = set()
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        source, _, _ = ENV.loader.get_source(ENV, name)
+        digest.update(b'\0' + name.encode() + b'\0' + source.encode())
+        for reference in _referenced_templates(name, source):
+            if reference is None:
+                raise ValueError(f"{name} references a template by a dynamic name")
+            pending.append(reference)
+    digest.update(b'\0' + vars_digest.encode())
+    return digest.hexdigest()
+
+def is_output_up_to_date(output_file: pathlib.Path, input_hash: str) -> bool:
+    """Check if an output file was generated from inputs with the given hash.
+    
+    Compares against the hash stored in HASH_DIR, so the check does not depend on
+    file modification times.
+    """
+    hash_file = get_hash_file(output_file)
+    if not output_file.exists() or not hash_file.exists():
+        return False
+    try:
+        return hash_file.read_text().strip() == input_hash
+    except OSError:
+        return False
+
 def remove(file_path: pathlib.Path):
     output_file = get_output_file(file_path)
     print(f"{file_path} deleted, removing: {output_file}")
@@ -204,79 +613,258 @@ def remove(file_path: pathlib.Path):
         print(f"Output file {output_file} does not exist, skipping removal")
     except Exception as e:
         print(f"Error removing {output_file}: {e}")
+    store_input_hash(output_file, None)
+
+@dataclass
+class RenderedOutput:
+    content: str
+    output_file: pathlib.Path
+    input_hash: str | None
+    skip_prettier: bool = False
 
-def compile(file_path: pathlib.Path):
+def compile(file_path: pathlib.Path, reason: str = 'Compiling') -> RenderedOutput | None:
+    """Render a template in memory.
+    
+    Returns the rendered output, which still has to be formatted and written by
+    write_outputs(), or None if the template was skipped or failed to render.
+    """
+    # Use one config snapshot for the whole compile, even if the config is reloaded meanwhile
+    config = CONFIG
+    
     # Check if this file should be skipped
-    if is_file_skipped(file_path):
+    if is_file_skipped(file_path, config):
         relative_path = file_path.relative_to(HASS_CONFIG_DIR)
         print(f"Skipping {relative_path} (in .skipped_files)")
-        return
+        return None
     
     output_file = get_output_file(file_path)
-    print(f"Compiling {file_path} to: {output_file}")
+    print(f"{reason} {file_path} to: {output_file}")
     error_log_file = file_path.parent / f"{file_path.name}.errors.log"
     result_content = f"# DO NOT EDIT: Generated from: {file_path.name}\n"
     
     # Get variables for this specific file (global + file-specific merged)
-    file_vars = get_variables_for_file(file_path)
+    file_vars = get_variables_for_file(file_path, config)
     
-    # Create a temporary YAML file with the merged config variables for j2
-    with tempfile.NamedTemporaryFile(mode='w+t', delete=False, suffix=".yaml") as vars_file:
-        yaml.dump(file_vars, vars_file)
-        vars_file_path = vars_file.name
+    try:
+        input_hash = compute_input_hash(file_path, get_variables_digest(file_path, config))
+    except Exception as e:
+        # Never treat a hashing problem as a render error; just compile without the check
+        print(f"Warning: Cannot hash the inputs of {file_path}, compiling it anyway: {e}")
+        input_hash = None
+    if input_hash is not None and is_output_up_to_date(output_file, input_hash):
+        print(f"{file_path} is unchanged, skipping")
+        return None
     
     try:
-        result = subprocess.run(['j2', '--customize', '/etc/jinja2config/j2_customizations.py', '--format', 'yaml', str(file_path), vars_file_path], capture_output=True)
-    finally:
-        # Clean up the temporary variables file
-        if os.path.exists(vars_file_path):
-            os.remove(vars_file_path)
+        template = ENV.get_template(file_path.relative_to(HASS_CONFIG_DIR).as_posix())
+        rendered = template.render(file_vars)
+        error = None
+    except Exception:
+        rendered = None
+        error = traceback.format_exc()
     
-    if result.returncode == 0:
-        result_content += result.stdout.decode()
+    if error is None:
+        result_content += rendered
         if os.path.exists(error_log_file):
             os.remove(error_log_file)
-        # Create a temporary file
-        with tempfile.NamedTemporaryFile(mode='w+t', delete_on_close=False, suffix=".yaml") as f:
-            f.write(result_content)
-            f.flush()
-            f.close()
-            print(f"Using Prettier to formatting temp file '{f.name}' for '{output_file.name}'...")
-            subprocess.run(['prettier', '--write', f.name, '--log-level', 'warn'])
-            print(f"Copying temp file '{f.name}' to '{output_file}'...")
-            shutil.copyfile(f.name, output_file)
+        return RenderedOutput(result_content, output_file, input_hash, is_prettier_skipped(file_path, config))
     else:
         if output_file.exists():
             os.remove(output_file)
+        store_input_hash(output_file, None)
         print(f"Error compiling {file_path}!")
-        with open(error_log_file, 'wb') as err_f:
-            err_f.write(result.stderr)
-        print(result.stderr.decode())
+        try:
+            with open(error_log_file, 'w') as err_f:
+                err_f.write(error)
+        except OSError as e:
+            # e.g. the template's directory was removed while it was queued
+            print(f"Warning: Cannot write {error_log_file}: {e}")
+        print(error)
+        return None
+
+def format_with_prettier(output: RenderedOutput) -> str:
+    """Format rendered content by piping it through Prettier.
+    
+    Returns the unformatted content if Prettier fails.
+    """
+    result = subprocess.run(
+        ['prettier', '--parser', 'yaml', '--stdin-filepath', str(output.output_file), '--log-level', 'warn'],
+        input=output.content.encode(),
+        capture_output=True
+    )
+    if result.returncode != 0:
+        print(f"Warning: Prettier failed for '{output.output_file}': {result.stderr.decode()}")
+        return output.content
+    return result.stdout.decode()
 
-def recompile(file_path: pathlib.Path):
-    print(f"Recompiling {file_path} due to changes")
-    compile(file_path)
+def start_prettier_server():
+    """Start the long-lived Prettier formatter process.
+    
+    Leaves PRETTIER_SERVER unset if it cannot be started, in which case the prettier CLI is used.
+    """
+    global PRETTIER_SERVER
+    if not PRETTIER_SERVER_PATH.exists() or not shutil.which('node') or not shutil.which('npm'):
+        print("Prettier server not available, using the prettier CLI")
+        return
+    try:
+        # Let the server require() the globally installed prettier package
+        node_path = subprocess.run(['npm', 'root', '-g'], capture_output=True, text=True, check=True).stdout.strip()
+        PRETTIER_SERVER = subprocess.Popen(
+            ['node', str(PRETTIER_SERVER_PATH)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            env={**os.environ, 'NODE_PATH': node_path}
+        )
+        atexit.register(PRETTIER_SERVER.terminate)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Warning: Cannot start Prettier server, using the prettier CLI: {e}")
 
-def find_all_jinja_templates():
-    """Find all .yaml.jinja template files in the config directory, excluding skipped files"""
+def format_with_prettier_server(output: RenderedOutput) -> str | None:
+    """Format rendered content with the long-lived Prettier server.
+    
+    Returns the unformatted content if Prettier rejects it, or None if the server is not running.
+    """
+    global PRETTIER_SERVER
+    request = json.dumps({'filepath': str(output.output_file), 'source': output.content})
+    with PRETTIER_SERVER_LOCK:
+        if PRETTIER_SERVER is None:
+            return None
+        try:
+            PRETTIER_SERVER.stdin.write(request + '\n')
+            PRETTIER_SERVER.stdin.flush()
+            line = PRETTIER_SERVER.stdout.readline()
+        except OSError:
+            line = ''
+        if not line:
+            print("Warning: Prettier server stopped, falling back to the prettier CLI")
+            PRETTIER_SERVER = None
+            return None
+    
+    response = json.loads(line)
+    if 'error' in response:
+        print(f"Warning: Prettier failed for '{output.output_file}': {response['error']}")
+        return output.content
+    return response['formatted']
+
+def create_temp_file(output_file: pathlib.Path, content: str) -> pathlib.Path:
+    """Write content to a hidden temp file next to output_file, so it can be renamed over it.
+    
+    If output_file is a symlink, the temp file is created next to its target instead. The
+    temp file takes over the mode and, where permitted, the owner of the existing output.
+    """
+    target = output_file.resolve()
+    with tempfile.NamedTemporaryFile(mode='w+t', dir=target.parent, prefix=f".{target.name}.",
+                                     suffix='.tmp', delete=False) as f:
+        f.write(content)
+    try:
+        st = target.stat()
+    except FileNotFoundError:
+        os.chmod(f.name, 0o644)
+    else:
+        os.chmod(f.name, stat.S_IMODE(st.st_mode))
+        try:
+            os.chown(f.name, st.st_uid, st.st_gid)
+        except OSError:
+            # Not running as root, keep our own ownership
+            pass
+    return pathlib.Path(f.name)
+
+def replace_output(output: RenderedOutput, tmp_path: pathlib.Path):
+    """Atomically move a temp file over the output file and record its input hash.
+    
+    A symlinked output keeps its link; the file it points to is replaced.
+    """
+    print(f"Writing '{output.output_file}'...")
+    try:
+        os.replace(tmp_path, output.output_file.resolve())
+    except Exception as e:
+        tmp_path.unlink(missing_ok=True)
+        print(f"Error writing {output.output_file}: {e}")
+        return
+    store_input_hash(output.output_file, output.input_hash)
+
+def save_output(output: RenderedOutput, content: str):
+    """Atomically replace the output file with content and record its input hash."""
+    try:
+        tmp_path = create_temp_file(output.output_file, content)
+    except Exception as e:
+        print(f"Error writing {output.output_file}: {e}")
+        return
+    replace_output(output, tmp_path)
+
+def write_outputs(outputs: list[RenderedOutput]):
+    """Format rendered outputs with the prettier CLI and write them into place.
+    
+    Used when the Prettier server is not running. A single output is piped through prettier,
+    and larger batches are written to temp files and formatted with a single prettier run,
+    so Node only starts once per window.
+    """
+    if len(outputs) == 1:
+        output = outputs[0]
+        print(f"Using Prettier to format '{output.output_file.name}'...")
+        save_output(output, format_with_prettier(output))
+        return
+    
+    # The temp files live next to their outputs, so they are renamed into place, not copied
+    pending = []
+    for output in outputs:
+        try:
+            pending.append((output, create_temp_file(output.output_file, output.content)))
+        except Exception as e:
+            print(f"Error writing {output.output_file}: {e}")
+    if not pending:
+        return
+    print(f"Using Prettier to format {len(pending)} temp file(s)...")
+    subprocess.run(['prettier', '--write', '--parser', 'yaml', '--log-level', 'warn',
+                    *(str(tmp_path) for _, tmp_path in pending)])
+    for output, tmp_path in pending:
+        replace_output(output, tmp_path)
+
+# All known .yaml.jinja templates (including skipped ones), kept up to date by JinjaEventHandler
+KNOWN_TEMPLATES: set[pathlib.Path] = set()
+# Guards KNOWN_TEMPLATES, which is changed from the watchdog observer thread
+KNOWN_TEMPLATES_LOCK = threading.Lock()
+
+def scan_jinja_templates():
+    """Walk the config directory and return all .yaml.jinja template files"""
     templates = []
     for root, _, files in os.walk(HASS_CONFIG_DIR):
         for file in files:
             if file.endswith('.yaml.jinja'):
-                file_path = pathlib.Path(root) / file
-                if not is_file_skipped(file_path):
-                    templates.append(file_path)
+                templates.append(pathlib.Path(root) / file)
     return templates
 
+def find_all_jinja_templates():
+    """Find all known .yaml.jinja template files, excluding skipped files.
+    
+    Templates that no longer exist are dropped, in case their removal was never reported.
+    """
+    with KNOWN_TEMPLATES_LOCK:
+        templates = list(KNOWN_TEMPLATES)
+    missing = {p for p in templates if not p.exists()}
+    if missing:
+        with KNOWN_TEMPLATES_LOCK:
+            KNOWN_TEMPLATES.difference_update(missing)
+    config = CONFIG
+    return sorted(p for p in templates if p not in missing and not is_file_skipped(p, config))
+
 @dataclass
 class ChangeRecorder:
     path: pathlib.Path
     deleted: bool = False
     initial_compile: bool = False
     
-QUEUE: list[ChangeRecorder] = []
+# Pending changes keyed by path, so repeated events for a file collapse into one entry
+QUEUE: dict[pathlib.Path, ChangeRecorder] = {}
+# Guards QUEUE, which is filled from the watchdog observer thread
+QUEUE_CONDITION = threading.Condition()
 WINDOW_START: float | None = None
+DEBOUNCE_SECONDS = 5
 SHUTDOWN = False
+# Shared across debounce windows; bounded so concurrent Prettier runs don't thrash the CPU
+EXECUTOR = ThreadPoolExecutor(max_workers=min(os.cpu_count() or 1, 8), thread_name_prefix='jinja2config')
+atexit.register(EXECUTOR.shutdown, wait=True)
 
 
 def signal_handler(signum, frame):
@@ -284,17 +872,47 @@ def signal_handler(signum, frame):
     global SHUTDOWN
     print(f"Received signal {signum}, initiating graceful shutdown...", file=sys.stderr)
     SHUTDOWN = True
+    # Wake the main loop, a signal alone does not interrupt QUEUE_CONDITION.wait().
+    # The condition's lock is reentrant, so this is safe even if the main thread holds it.
+    with QUEUE_CONDITION:
+        QUEUE_CONDITION.notify()
+
+def enqueue(*changes: ChangeRecorder):
+    """Add changes to the queue and wake up the main loop"""
+    with QUEUE_CONDITION:
+        for change in changes:
+            # The latest event for a path wins, e.g. a template deleted and recreated is compiled
+            QUEUE[change.path] = change
+        QUEUE_CONDITION.notify()
+
+class JinjaEventHandler(PatternMatchingEventHandler):
+    def __init__(self):
+        # Only templates and the config file reach the handlers; generated outputs are ignored
+        super().__init__(patterns=['*.yaml.jinja', str(CONFIG_FILE_PATH)], ignore_directories=True,
+                         case_sensitive=True)
+
+    def dispatch(self, event):
+        # ignore_directories drops directory events, but a directory that is deleted or moved
+        # away takes its templates with it, often without an event for each of them
+        if event.is_directory and event.event_type in ('deleted', 'moved'):
+            self._forget_directory(pathlib.Path(event.src_path))
+        super().dispatch(event)
 
+    def _forget_directory(self, directory: pathlib.Path):
+        with KNOWN_TEMPLATES_LOCK:
+            removed = [p for p in KNOWN_TEMPLATES if p.is_relative_to(directory)]
+            KNOWN_TEMPLATES.difference_update(removed)
+        enqueue(*(ChangeRecorder(p, deleted=True) for p in removed))
 
-class JinjaEventHandler(FileSystemEventHandler):
     def _handle(self, event):
-        if not event.is_directory:
-            if event.src_path.endswith('.yaml.jinja'):
-                file_path = pathlib.Path(event.src_path)
-                if not is_file_skipped(file_path):
-                    QUEUE.append(ChangeRecorder(file_path))
-            elif event.src_path == CONFIG_FILE_PATH:
-                self._recompile_all_templates()
+        if event.src_path == str(CONFIG_FILE_PATH):
+            self._recompile_all_templates()
+        else:
+            file_path = pathlib.Path(event.src_path)
+            with KNOWN_TEMPLATES_LOCK:
+                KNOWN_TEMPLATES.add(file_path)
+            if not is_file_skipped(file_path, CONFIG):
+                enqueue(ChangeRecorder(file_path))
                 
     def on_created(self, event):
         self._handle(event)
@@ -303,73 +921,107 @@ class JinjaEventHandler(FileSystemEventHandler):
         self._handle(event)
 
     def on_deleted(self, event):
-        if not event.is_directory and event.src_path.endswith('.yaml.jinja'):
-            QUEUE.append(ChangeRecorder(pathlib.Path(event.src_path), deleted=True))
+        if event.src_path != str(CONFIG_FILE_PATH):
+            with KNOWN_TEMPLATES_LOCK:
+                KNOWN_TEMPLATES.discard(pathlib.Path(event.src_path))
+            enqueue(ChangeRecorder(pathlib.Path(event.src_path), deleted=True))
 
     def on_moved(self, event):
-        if not event.is_directory and event.dest_path.endswith('.yaml.jinja'):
-            QUEUE.append(ChangeRecorder(pathlib.Path(event.dest_path)))
-        if not event.is_directory and event.src_path.endswith('.yaml.jinja'):
-            QUEUE.append(ChangeRecorder(pathlib.Path(event.src_path), deleted=True))
+        # Either side of a move may be the one that matched the patterns
+        if event.dest_path == str(CONFIG_FILE_PATH):
+            self._recompile_all_templates()
+        elif event.dest_path.endswith('.yaml.jinja'):
+            with KNOWN_TEMPLATES_LOCK:
+                KNOWN_TEMPLATES.add(pathlib.Path(event.dest_path))
+            enqueue(ChangeRecorder(pathlib.Path(event.dest_path)))
+        if event.src_path.endswith('.yaml.jinja'):
+            with KNOWN_TEMPLATES_LOCK:
+                KNOWN_TEMPLATES.discard(pathlib.Path(event.src_path))
+            enqueue(ChangeRecorder(pathlib.Path(event.src_path), deleted=True))
     
     def _recompile_all_templates(self):
         """Recompile all templates when config file changes"""
         print(f"{CONFIG_FILE_NAME} changed, reloading variables and recompiling all templates...")
         load_config_variables()
-        for template_path in find_all_jinja_templates():
-            QUEUE.append(ChangeRecorder(template_path))
+        enqueue(*(ChangeRecorder(template_path) for template_path in find_all_jinja_templates()))
 
-def process_change(change: ChangeRecorder):
+def process_change(change: ChangeRecorder) -> RenderedOutput | None:
+    """Process a single change on the executor.
+    
+    Returns the rendered output if it still has to be formatted by write_outputs().
+    """
     if change.deleted:
         remove(change.path)
-    else:
-        if change.initial_compile:
-            compile(change.path)
-        else:
-            recompile(change.path)
+        return None
+    
+    output = compile(change.path, 'Compiling' if change.initial_compile else 'Recompiling')
+    if output is not None and output.skip_prettier:
+        print(f"Skipping Prettier for '{output.output_file.name}' (.skip_prettier)")
+        save_output(output, output.content)
+        return None
+    if output is not None:
+        # Format and write in the same task, so this template's I/O overlaps with other renders
+        formatted = format_with_prettier_server(output)
+        if formatted is not None:
+            save_output(output, formatted)
+            return None
+    return output
 
 def process_changes(changes: list[ChangeRecorder]):
-    deduped = {}
-    for change in changes:
-        deduped[change.path] = change
-
-    with ThreadPoolExecutor() as executor:
-        futures = [executor.submit(process_change, change) for change in deduped.values()]
-        for future in futures:
-            future.result()
+    # Render (and format, if the Prettier server is running) all templates in parallel,
+    # then format and write any remaining outputs with the prettier CLI in one batch
+    futures = [EXECUTOR.submit(process_change, change) for change in changes]
+    wait(futures)
+    outputs = [output for output in (future.result() for future in futures) if output is not None]
+    if outputs:
+        write_outputs(outputs)
 
 def main():
-    global QUEUE, WINDOW_START, SHUTDOWN
+    global WINDOW_START
     
     # Register signal handlers
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
     
     check_dependencies()
+    start_prettier_server()
     
     # Load config variables and fetch HA entities at startup
+    start_ha_entities_subscription()
     load_config_variables()
     
-    print(f"Compiling Jinja templates to YAML: {HASS_CONFIG_DIR}/**/*.yaml.jinja")
-    for template_path in find_all_jinja_templates():
-        QUEUE.append(ChangeRecorder(template_path, initial_compile=True))
-
+    # Watch before the initial compile, so edits made while it runs are queued instead of lost
     event_handler = JinjaEventHandler()
-    observer = Observer()
+    observer = InotifyObserver()
     observer.schedule(event_handler, HASS_CONFIG_DIR, recursive=True)
     observer.start()
 
     try:
+        # Compile everything right away instead of waiting for the first debounce window
+        print(f"Compiling Jinja templates to YAML: {HASS_CONFIG_DIR}/**/*.yaml.jinja")
+        templates = scan_jinja_templates()
+        with KNOWN_TEMPLATES_LOCK:
+            KNOWN_TEMPLATES.update(templates)
+        process_changes([ChangeRecorder(template_path, initial_compile=True)
+                         for template_path in find_all_jinja_templates()])
+
         while not SHUTDOWN:
-            time.sleep(1)
-            if QUEUE:
+            with QUEUE_CONDITION:
+                if not QUEUE:
+                    # Idle: sleep until a change arrives (bounded so shutdown is noticed)
+                    QUEUE_CONDITION.wait(timeout=DEBOUNCE_SECONDS)
+                    continue
                 if WINDOW_START is None:
                     WINDOW_START = time.time()
-                elif time.time() - WINDOW_START > 5:
-                    queue = QUEUE
-                    QUEUE = []
-                    process_changes(queue)
-                    WINDOW_START = None
+                remaining = WINDOW_START + DEBOUNCE_SECONDS - time.time()
+                if remaining > 0:
+                    # Let more changes accumulate until the debounce window closes
+                    QUEUE_CONDITION.wait(timeout=remaining)
+                    continue
+                queue = list(QUEUE.values())
+                QUEUE.clear()
+                WINDOW_START = None
+            process_changes(queue)
     finally:
         print("Stopping observer...", file=sys.stderr)
         observer.stop()
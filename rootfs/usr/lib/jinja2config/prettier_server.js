@@ -0,0 +1,24 @@
+// Long-lived Prettier formatter used by jinja2config.py, so Node only starts once.
+// Reads one JSON request per line from stdin: {"filepath": "...", "source": "..."}
+// Writes one JSON response per line to stdout: {"formatted": "..."} or {"error": "..."}
+const readline = require('readline');
+const prettier = require('prettier');
+
+async function format(line) {
+  try {
+    const request = JSON.parse(line);
+    const options = (await prettier.resolveConfig(request.filepath)) || {};
+    const formatted = await prettier.format(request.source, { ...options, filepath: request.filepath });
+    return { formatted };
+  } catch (e) {
+    return { error: String((e && e.message) || e) };
+  }
+}
+
+// Handle requests one at a time so responses stay in request order
+let pending = Promise.resolve();
+readline.createInterface({ input: process.stdin, crlfDelay: Infinity }).on('line', (line) => {
+  pending = pending.then(async () => {
+    process.stdout.write(JSON.stringify(await format(line)) + '\n');
+  });
+});